@@ -4,20 +4,28 @@ Improved RAG Chain with Debugging Capabilities
 This script helps identify and fix issues with the RAG chain implementation.
 """
 
+import io
 import os
+import sys
+import asyncio
+import functools
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import FAISS
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from utils.rag_ops import load_embedding_model, load_or_build_vectorstore, split_by_sentences
+from utils.semantic_cache import GenerativeCache, QueryCache
 
 # Load environment variables
 load_dotenv()
 
+# Questions evaluated at once; set to 1 to stream each answer token by token instead
+MAX_CONCURRENT_QUESTIONS = int(os.getenv("RAG_MAX_CONCURRENT_QUESTIONS", "8"))
+STREAM_ANSWERS = MAX_CONCURRENT_QUESTIONS == 1
+
+# Retrieval used for the answer: MMR drops near-duplicate chunks, keeping the prompt short
+OPTIMAL_MMR = {"k": 4, "fetch_k": 20, "lambda_mult": 0.5}
+
 def setup_components():
     """Setup all RAG components with improved configurations."""
     
@@ -28,30 +36,24 @@ def setup_components():
     )
     
     # 2. Initialize embedding model
-    embedding_model = GoogleGenerativeAIEmbeddings(
-        model="models/embedding-001"
+    embedding_model = load_embedding_model()  # local infinity server if INFINITY_API_URL is set
+    
+    # 3. Sentence-aware text splitting (spaCy), never cuts mid-sentence
+    text_splitter = functools.partial(
+        split_by_sentences,
+        target_chars=1000,
+        overlap_sentences=1  # Carry the last sentence into the next chunk
     )
     
-    # 3. Load documents
+    # 4 + 5. Load, split and embed documents (skipped when the cached index is still valid)
     dir_path = os.path.join(os.getcwd(), "notebook", "data")
-    dir_loader = DirectoryLoader(dir_path, glob="**/*.pdf", loader_cls=PyPDFLoader)
-    docs = dir_loader.load()
-    print(f"Loaded {len(docs)} documents")
-    
-    # 4. Improved text splitting
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,  # Increased from 500 for better context
-        chunk_overlap=200,  # Increased overlap
-        length_function=len,
-        separators=["\n\n", "\n", ". ", " ", ""]  # Better separators
+    vectordb, split_docs = load_or_build_vectorstore(
+        dir_path,
+        embedding_model,
+        text_splitter,
     )
-    
-    split_docs = text_splitter.split_documents(docs)
     print(f"Split into {len(split_docs)} chunks")
     
-    # 5. Create vector store
-    vectordb = FAISS.from_documents(split_docs, embedding_model)
-    
     return llm, embedding_model, vectordb, split_docs
 
 def create_improved_prompt():
@@ -79,19 +81,26 @@ Answer:"""
 
 def format_docs(docs):
     """Format documents for the prompt."""
-    return "\n\n".join([doc.page_content for doc in docs])
+    return "\n\n".join(doc.page_content for doc in docs)
 
-def debug_rag_chain(question, vectordb, llm, prompt):
+async def debug_rag_chain(question, vectordb, llm, prompt, query_cache=None, answer_cache=None):
     """Debug the RAG chain step by step."""
     
-    print("=" * 80)
-    print("RAG CHAIN DEBUG")
-    print("=" * 80)
-    print(f"Question: {question}")
+    # Questions run concurrently, so buffer the report and print it in one piece at the end
+    report = io.StringIO()
+    emit = functools.partial(print, file=report)
+    
+    # Shared across questions so repeated/near-duplicate questions skip retrieval
+    query_cache = query_cache or QueryCache(vectordb.embedding_function)
+    
+    emit("=" * 80)
+    emit("RAG CHAIN DEBUG")
+    emit("=" * 80)
+    emit(f"Question: {question}")
     
     # 1. Test retrieval
-    print("\n1. TESTING RETRIEVAL")
-    print("-" * 40)
+    emit("\n1. TESTING RETRIEVAL")
+    emit("-" * 40)
     
     # Try different retriever configurations
     retriever_configs = [
@@ -101,65 +110,91 @@ def debug_rag_chain(question, vectordb, llm, prompt):
         {"k": 3, "search_type": "mmr"}  # Maximum Marginal Relevance
     ]
     
+    max_k = max(c["k"] for c in retriever_configs if c["search_type"] == "similarity")
+    mmr_k = max(c["k"] for c in retriever_configs if c["search_type"] == "mmr")
+    
+    def search_all(query_vector):
+        # One similarity scan at max_k serves every k (results are score-ordered); each MMR config runs once
+        return {
+            "similarity": vectordb.similarity_search_by_vector(query_vector, k=max_k),
+            "mmr": vectordb.max_marginal_relevance_search_by_vector(query_vector, k=mmr_k),
+            "optimal": vectordb.max_marginal_relevance_search_by_vector(query_vector, **OPTIMAL_MMR),
+        }
+    
+    # The question is embedded once (or not at all on a cache hit)
+    results = await asyncio.to_thread(
+        query_cache.get_or_search, question, search_all, f"debug:{max_k}:{mmr_k}:{sorted(OPTIMAL_MMR.items())}"
+    )
+    
     for i, config in enumerate(retriever_configs):
-        print(f"\nRetriever config {i+1}: {config}")
-        retriever = vectordb.as_retriever(**config)
-        retrieved_docs = retriever.get_relevant_documents(question)
+        emit(f"\nRetriever config {i+1}: {config}")
+        retrieved_docs = results[config["search_type"]][:config["k"]]
         
-        print(f"  Retrieved {len(retrieved_docs)} documents")
+        emit(f"  Retrieved {len(retrieved_docs)} documents")
         if retrieved_docs:
-            print(f"  First doc preview: {retrieved_docs[0].page_content[:200]}...")
-            print(f"  Source: {retrieved_docs[0].metadata.get('source', 'Unknown')}")
+            emit(f"  First doc preview: {retrieved_docs[0].page_content[:200]}...")
+            emit(f"  Source: {retrieved_docs[0].metadata.get('source', 'Unknown')}")
     
     # 2. Test with best configuration
-    print("\n2. USING OPTIMAL CONFIGURATION")
-    print("-" * 40)
+    emit("\n2. USING OPTIMAL CONFIGURATION")
+    emit("-" * 40)
     
-    best_retriever = vectordb.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": 5}
-    )
-    
-    retrieved_docs = best_retriever.get_relevant_documents(question)
-    print(f"Retrieved {len(retrieved_docs)} documents")
+    emit(f"MMR config: {OPTIMAL_MMR}")
+    retrieved_docs = results["optimal"]
+    emit(f"Retrieved {len(retrieved_docs)} documents")
     
     # Show all retrieved documents
     for i, doc in enumerate(retrieved_docs):
-        print(f"\nDocument {i+1}:")
-        print(f"  Content: {doc.page_content[:300]}...")
-        print(f"  Source: {doc.metadata.get('source', 'Unknown')}")
-        print(f"  Page: {doc.metadata.get('page', 'Unknown')}")
+        emit(f"\nDocument {i+1}:")
+        emit(f"  Content: {doc.page_content[:300]}...")
+        emit(f"  Source: {doc.metadata.get('source', 'Unknown')}")
+        emit(f"  Page: {doc.metadata.get('page', 'Unknown')}")
     
     # 3. Test prompt formatting
-    print("\n3. TESTING PROMPT FORMATTING")
-    print("-" * 40)
+    emit("\n3. TESTING PROMPT FORMATTING")
+    emit("-" * 40)
     
     formatted_context = format_docs(retrieved_docs)
-    print(f"Formatted context length: {len(formatted_context)} characters")
-    print(f"Context preview: {formatted_context[:500]}...")
+    emit(f"Formatted context length: {len(formatted_context)} characters")
+    emit(f"Context preview: {formatted_context[:500]}...")
     
     # 4. Test LLM response
-    print("\n4. TESTING LLM RESPONSE")
-    print("-" * 40)
-    
-    # Create the RAG chain
-    rag_chain = (
-        {"context": best_retriever | format_docs, "question": RunnablePassthrough()}
-        | prompt
-        | llm
-        | StrOutputParser()
-    )
+    emit("\n4. TESTING LLM RESPONSE")
+    emit("-" * 40)
     
+    # Create the RAG chain (context is already retrieved above, so no second search)
+    generator = prompt | llm
+    if answer_cache is not None:
+        generator = answer_cache.wrap(generator)
+    rag_chain = generator | StrOutputParser()
+    
+    inputs = {"context": formatted_context, "question": question}
+    answer = None
     try:
-        answer = rag_chain.invoke(question)
-        print("SUCCESS! Generated answer:")
-        print(answer)
-        return answer
+        if STREAM_ANSWERS:
+            # Flush the report so far, then print tokens as they arrive
+            print(report.getvalue(), end="", flush=True)
+            report.seek(0)
+            report.truncate()
+            print("Generated answer (streaming):", flush=True)
+            tokens = []
+            async for token in rag_chain.astream(inputs):
+                tokens.append(token)
+                sys.stdout.write(token)
+                sys.stdout.flush()
+            answer = "".join(tokens)
+            emit()
+        else:
+            answer = await rag_chain.ainvoke(inputs)
+            emit("SUCCESS! Generated answer:")
+            emit(answer)
     except Exception as e:
-        print(f"ERROR: {e}")
-        return None
+        emit(f"ERROR: {e}")
+    
+    print(report.getvalue(), flush=True)
+    return answer
 
-def test_different_questions():
+async def test_different_questions(llm, embedding_model, vectordb):
     """Test the RAG chain with different types of questions."""
     
     test_questions = [
@@ -170,16 +205,24 @@ def test_different_questions():
         "What are the benchmark results?"
     ]
     
-    print("Setting up components...")
-    llm, embedding_model, vectordb, split_docs = setup_components()
     prompt = create_improved_prompt()
+    query_cache = QueryCache(embedding_model)
+    # Semantic answer cache: near-duplicate questions over the same context skip the Groq call
+    answer_cache = GenerativeCache(embedding_model, query_cache=query_cache)  # reuses the retrieval embedding
+    
+    # Questions are independent: overlap their LLM round-trips, bounded to stay under rate limits
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUESTIONS)
+    
+    async def run_one(question):
+        async with semaphore:
+            return await debug_rag_chain(question, vectordb, llm, prompt, query_cache, answer_cache)
     
     print("\nTesting different questions...")
-    for question in test_questions:
-        print(f"\n{'='*60}")
-        print(f"Testing: {question}")
-        print(f"{'='*60}")
-        debug_rag_chain(question, vectordb, llm, prompt)
+    await asyncio.gather(*(run_one(q) for q in test_questions))
 
 if __name__ == "__main__":
-    test_different_questions() 
\ No newline at end of file
+    # Build synchronously, before any event loop exists: setup_components runs its own loop for
+    # batch embedding and forks worker processes for PDF parsing and chunking.
+    print("Setting up components...")
+    llm, embedding_model, vectordb, split_docs = setup_components()
+    asyncio.run(test_different_questions(llm, embedding_model, vectordb)) 
\ No newline at end of file
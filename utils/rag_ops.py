@@ -0,0 +1,300 @@
+from __future__ import annotations
+import os
+import glob
+import pickle
+import shutil
+import asyncio
+import hashlib
+import functools
+import warnings
+import itertools
+import multiprocessing
+from typing import Callable, List, Tuple
+
+import faiss
+import numpy as np
+import spacy
+from langchain.schema import Document
+from langchain_community.document_loaders import PyPDFium2Loader
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.embeddings import InfinityEmbeddings
+from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+from logger.custom_logger import CustomLogger
+from exception.custom_exception import DocumentPortalException
+
+log = CustomLogger().get_logger(__name__)
+
+CACHE_DIR = os.path.join(os.getcwd(), "cache")
+PDF_LOADER = "pypdfium2"
+DEFAULT_INFINITY_MODEL = "BAAI/bge-small-en-v1.5"
+# Any faiss.index_factory string, e.g. "HNSW32", "IVF256,PQ32", "Flat".
+# Default: 4-bit PQ FastScan (SIMD LUT scan), shortlist re-ranked against int8 (SQ8) codes
+# rather than a float32 copy, so stored vectors take 1 byte/dim instead of 4.
+DEFAULT_INDEX_FACTORY = "PQ32x4fs,Refine(SQ8)"
+
+
+def _pdf_files(dir_path: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(dir_path, "**", "*.pdf"), recursive=True))
+
+def _file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _load_one(path: str) -> List[Document]:
+    """
+    Parse a single PDF (runs inside a pool worker, so must stay module-level).
+    Parsed pages are cached under cache/pdf/, keyed by loader and file hash, so unchanged files skip parsing.
+    """
+    cache_path = os.path.join(CACHE_DIR, "pdf", f"{PDF_LOADER}-{_file_sha256(path)}.pkl")
+    if os.path.exists(cache_path):
+        with open(cache_path, "rb") as f:
+            docs = pickle.load(f)  # written below, trusted
+        for d in docs:
+            d.metadata["source"] = path  # same content may have moved
+        return docs
+
+    docs = PyPDFium2Loader(path).load()  # pdfium (C++) extracts text several times faster than pypdf
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(docs, f)
+    os.replace(tmp_path, cache_path)  # atomic, so parallel workers never see a partial file
+    return docs
+
+def _worker_count(n_items: int) -> int:
+    """Worker processes for parsing/chunking: LOAD_DOCUMENTS_NUMBER_OF_THREADS, else all cores but one."""
+    env = os.getenv("LOAD_DOCUMENTS_NUMBER_OF_THREADS")
+    workers = int(env) if env else (os.cpu_count() or 2) - 1
+    return max(1, min(workers, n_items))
+
+def load_pdf_dir(dir_path: str) -> List[Document]:
+    """Load every PDF under dir_path, parsing files in parallel across processes."""
+    try:
+        all_files = _pdf_files(dir_path)
+        workers = _worker_count(len(all_files))
+        if workers == 1:
+            docs = list(itertools.chain.from_iterable(map(_load_one, all_files)))
+        else:
+            with multiprocessing.Pool(workers) as p:
+                docs = list(itertools.chain.from_iterable(p.imap(_load_one, all_files)))
+        log.info("PDFs loaded", files=len(all_files), pages=len(docs), workers=workers)
+        return docs
+    except Exception as e:
+        log.error("Failed loading PDFs", error=str(e), dir=dir_path)
+        raise DocumentPortalException("Error loading PDFs", e) from e
+
+@functools.lru_cache(maxsize=1)
+def _sentence_model():
+    # Only the dependency parser is needed for sentence boundaries
+    return spacy.load("en_core_web_sm", disable=["ner", "tagger", "attribute_ruler", "lemmatizer"])
+
+def _pack_sentences(sents: List[str], target_chars: int, overlap: int) -> List[str]:
+    """Greedily pack whole sentences into ~target_chars chunks, carrying `overlap` sentences over."""
+    chunks: List[str] = []
+    current: List[str] = []
+    size = 0
+    for sent in sents:
+        if current and size + len(sent) > target_chars:
+            chunks.append(" ".join(current))
+            current = current[-overlap:] if overlap else []
+            size = sum(len(s) + 1 for s in current)
+            if current and size + len(sent) > target_chars:
+                current, size = [], 0
+        current.append(sent)
+        size += len(sent) + 1
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+def split_by_sentences(docs: List[Document], target_chars: int = 1000, overlap_sentences: int = 1) -> List[Document]:
+    """
+    Chunk docs on spaCy sentence boundaries so no chunk starts or ends mid-sentence.
+    Pages are parsed with nlp.pipe across worker processes (sentence splitting is the CPU-bound part).
+    """
+    nlp = _sentence_model()
+    workers = _worker_count(len(docs) // 16)  # not worth forking for a handful of pages
+    parsed = nlp.pipe((d.page_content for d in docs), n_process=workers, batch_size=16)
+    chunks: List[Document] = []
+    for doc, spacy_doc in zip(docs, parsed):
+        sents = [s.text.strip() for s in spacy_doc.sents if s.text.strip()]
+        for text in _pack_sentences(sents, target_chars, overlap_sentences):
+            chunks.append(Document(page_content=text, metadata=dict(doc.metadata)))
+    return chunks
+
+def load_embedding_model(google_model: str = "models/embedding-001"):
+    """
+    Use a local infinity server when INFINITY_API_URL is set, else Google embeddings.
+    Start the sidecar with:
+        docker run -p 8000:7997 michaelf34/infinity:latest v2 --model-id BAAI/bge-small-en-v1.5
+    """
+    api_url = os.getenv("INFINITY_API_URL")
+    if api_url:
+        model = os.getenv("INFINITY_MODEL", DEFAULT_INFINITY_MODEL)
+        log.info("Using infinity embeddings", model=model, url=api_url)
+        return InfinityEmbeddings(model=model, infinity_api_url=api_url)
+    return GoogleGenerativeAIEmbeddings(model=google_model)
+
+async def _embed_all(texts: List[str], model, batch: int = 100, concurrency: int = 16) -> List[List[float]]:
+    """Embed texts in mini-batches, keeping up to `concurrency` requests in flight."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def _embed_batch(chunk: List[str]) -> List[List[float]]:
+        async with sem:
+            return await model.aembed_documents(chunk)
+
+    batches = [texts[i:i + batch] for i in range(0, len(texts), batch)]
+    results = await asyncio.gather(*(_embed_batch(b) for b in batches))
+    return list(itertools.chain.from_iterable(results))
+
+def _build_index(xb: np.ndarray, factory: str) -> faiss.Index:
+    """
+    Create and train an inner-product ANN index on unit-norm xb (so IP == cosine ranking);
+    fall back to exact search if the layout cannot be built.
+    """
+    dim = xb.shape[1]
+    simd = faiss.get_compile_options()
+    if "AVX2" not in simd and "AVX512" not in simd and "NEON" not in simd:
+        log.warning("faiss built without SIMD, FastScan will be slow", compile_options=simd)
+    try:
+        # Raises when dim is not divisible by the PQ sub-quantizer count or there are too few vectors to train.
+        index = faiss.index_factory(dim, factory, faiss.METRIC_INNER_PRODUCT)
+        if not index.is_trained:
+            index.train(xb)
+    except RuntimeError as e:
+        log.warning("Index build failed, using flat index", factory=factory, dim=dim, vectors=len(xb), error=str(e))
+        return faiss.IndexFlatIP(dim)
+    ivf = faiss.try_extract_index_ivf(index)
+    if isinstance(index, faiss.IndexRefine):
+        index.k_factor = 4  # re-rank 4*k FastScan candidates with finer distances
+    if ivf is not None:
+        ivf.nprobe = min(ivf.nlist, 16)
+        ivf.make_direct_map()  # MMR search reconstructs vectors by id
+    return index
+
+def _wrap_index(index: faiss.Index, docstore, index_to_docstore_id, embedding_model) -> FAISS:
+    """LangChain store over an inner-product index that L2-normalizes every vector and query."""
+    with warnings.catch_warnings():
+        # LangChain warns that normalize_L2 is meant for Euclidean; here it turns IP into cosine.
+        warnings.filterwarnings("ignore", message="Normalizing L2 is not applicable")
+        return FAISS(
+            embedding_function=embedding_model,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            normalize_L2=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
+
+def build_vectorstore(docs: List[Document], embedding_model) -> FAISS:
+    """Embed docs concurrently and build a FAISS store from the precomputed vectors."""
+    try:
+        texts = [d.page_content for d in docs]
+        # Embed in length order so each batch holds similarly sized chunks (less padding),
+        # then scatter the vectors back so they stay aligned with texts/metadatas.
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        sorted_vectors = asyncio.run(_embed_all([texts[i] for i in order], embedding_model))
+        vectors: List[List[float]] = [[] for _ in texts]
+        for pos, i in enumerate(order):
+            vectors[i] = sorted_vectors[pos]
+        factory = os.getenv("FAISS_INDEX_FACTORY", DEFAULT_INDEX_FACTORY)
+        xb = np.asarray(vectors, dtype="float32")
+        faiss.normalize_L2(xb)
+        index = _build_index(xb, factory)
+        vs = _wrap_index(index, InMemoryDocstore(), {}, embedding_model)
+        # Add the same unit vectors the index was trained on; LangChain's own normalize_L2 pass is then a no-op
+        vs.add_embeddings(list(zip(texts, xb.tolist())), metadatas=[d.metadata for d in docs])
+        log.info("Vector store built", chunks=len(texts), index=type(index).__name__)
+        return vs
+    except Exception as e:
+        log.error("Failed building vector store", error=str(e))
+        raise DocumentPortalException("Error building vector store", e) from e
+
+def _callable_key(fn) -> str:
+    """Stable description of a (possibly functools.partial-wrapped) function and its bound arguments."""
+    if isinstance(fn, functools.partial):
+        return f"{_callable_key(fn.func)}:{fn.args}:{sorted(fn.keywords.items())}"
+    return f"{getattr(fn, '__module__', '')}.{getattr(fn, '__qualname__', repr(fn))}"
+
+def corpus_signature(dir_path: str, *extra: object) -> str:
+    """Hash of PDF paths + mtimes and any build settings that change the index."""
+    h = hashlib.sha256()
+    for path in _pdf_files(dir_path):
+        h.update(f"{path}:{os.path.getmtime(path)}\n".encode("utf-8"))
+    for item in extra:
+        h.update(f"{item}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def _load_cached(cache_path: str, embedding_model) -> FAISS:
+    """
+    Like FAISS.load_local, but with our normalize/inner-product settings restored.
+    IO_FLAG_MMAP only memory-maps IVF inverted lists, so it pays off for IVF* factories; other
+    layouts (including the PQ FastScan + Refine default) are read fully into RAM.
+    """
+    index = faiss.read_index(
+        os.path.join(cache_path, "index.faiss"),
+        faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY,
+    )
+    with open(os.path.join(cache_path, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)  # written by save_local, trusted
+    return _wrap_index(index, docstore, index_to_docstore_id, embedding_model)
+
+def _save_atomic(vs: FAISS, cache_path: str) -> None:
+    """save_local into a temp dir, then move it into place so no reader ever sees a half-written entry."""
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    vs.save_local(tmp_path)
+    if os.path.exists(os.path.join(cache_path, "index.pkl")):
+        # A concurrent run with the same signature finished first; keep its copy
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    shutil.rmtree(cache_path, ignore_errors=True)  # leftovers from an interrupted pre-atomic save
+    try:
+        os.replace(tmp_path, cache_path)
+        log.info("Vector store cached", path=cache_path)
+    except OSError:
+        # Lost the race between rmtree and replace; the other run's copy is equivalent
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+def load_or_build_vectorstore(
+    dir_path: str,
+    embedding_model,
+    split_fn: Callable[[List[Document]], List[Document]],
+) -> Tuple[FAISS, List[Document]]:
+    """
+    Reuse the index saved under cache/<signature> when the PDFs and settings are unchanged,
+    otherwise load, split and embed the corpus and save the result for the next run.
+    split_fn's identity and partial() arguments are part of the signature, so a new chunking
+    config triggers a rebuild.
+    """
+    try:
+        factory = os.getenv("FAISS_INDEX_FACTORY", DEFAULT_INDEX_FACTORY)
+        model_name = getattr(embedding_model, "model", type(embedding_model).__name__)
+        sig = corpus_signature(dir_path, PDF_LOADER, factory, "ip-normalized", model_name, _callable_key(split_fn))
+        cache_path = os.path.join(CACHE_DIR, sig)
+
+        # index.pkl is written last by save_local, so its presence marks a complete entry
+        if os.path.exists(os.path.join(cache_path, "index.pkl")):
+            try:
+                vs = _load_cached(cache_path, embedding_model)
+                split_docs = [vs.docstore.search(doc_id) for doc_id in vs.index_to_docstore_id.values()]
+                log.info("Vector store loaded from cache", path=cache_path, chunks=len(split_docs))
+                return vs, split_docs
+            except Exception as e:
+                log.warning("Cached vector store unreadable, rebuilding", path=cache_path, error=str(e))
+                shutil.rmtree(cache_path, ignore_errors=True)
+
+        split_docs = split_fn(load_pdf_dir(dir_path))
+        vs = build_vectorstore(split_docs, embedding_model)
+        _save_atomic(vs, cache_path)
+        return vs, split_docs
+    except DocumentPortalException:
+        raise
+    except Exception as e:
+        log.error("Failed loading or building vector store", error=str(e), dir=dir_path)
+        raise DocumentPortalException("Error loading or building vector store", e) from e
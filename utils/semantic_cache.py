@@ -0,0 +1,214 @@
+from __future__ import annotations
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain.schema import Document
+from langchain_core.messages import BaseMessageChunk
+from langchain_core.runnables import RunnableGenerator, RunnableLambda
+
+from logger.custom_logger import CustomLogger
+
+log = CustomLogger().get_logger(__name__)
+
+
+class QueryCache:
+    """
+    Thread-safe LRU + TTL cache of retrieval results.
+
+    Entries are keyed by the question embedding: a new question whose cosine similarity
+    to a cached one is >= threshold reuses its results. Each entry holds one result
+    per namespace (retriever config), so one lookup serves every config for a question.
+    Create a new cache (or call clear()) whenever the underlying index is rebuilt.
+    """
+
+    def __init__(self, embedding_model, max_size: int = 2000, ttl: float = 600, threshold: float = 0.98):
+        self.embedding_model = embedding_model
+        self.max_size = max_size
+        self.ttl = ttl
+        self.threshold = threshold
+        self._lock = threading.RLock()
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._by_text: Dict[str, int] = {}
+        self._index: Optional[faiss.IndexIDMap2] = None
+        self._next_id = 0
+
+    @staticmethod
+    def _unit(vec: List[float]) -> np.ndarray:
+        x = np.asarray([vec], dtype="float32")
+        faiss.normalize_L2(x)
+        return x
+
+    def _drop(self, eid: int) -> None:
+        entry = self._entries.pop(eid, None)
+        if entry is None:
+            return
+        self._by_text.pop(entry["text"], None)
+        if self._index is not None:
+            self._index.remove_ids(np.array([eid], dtype="int64"))
+
+    def _live(self, eid: Optional[int]) -> Optional[Dict[str, Any]]:
+        if eid is None or eid not in self._entries:
+            return None
+        entry = self._entries[eid]
+        if entry["expires"] < time.monotonic():
+            self._drop(eid)
+            return None
+        self._entries.move_to_end(eid)
+        return entry
+
+    def _nearest(self, x: np.ndarray) -> Optional[int]:
+        if self._index is None or self._index.ntotal == 0:
+            return None
+        sims, ids = self._index.search(x, 1)
+        if ids[0][0] == -1 or sims[0][0] < self.threshold:
+            return None
+        return int(ids[0][0])
+
+    def _insert(self, question: str, vec: List[float], x: np.ndarray) -> Dict[str, Any]:
+        if self._index is None:
+            self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(x.shape[1]))
+        eid = self._next_id
+        self._next_id += 1
+        self._index.add_with_ids(x, np.array([eid], dtype="int64"))
+        entry = {"text": question, "vec": vec, "expires": time.monotonic() + self.ttl, "results": {}}
+        self._entries[eid] = entry
+        self._by_text[question] = eid
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+        return entry
+
+    def vector_for(self, question: str) -> Optional[List[float]]:
+        """Embedding already computed for exactly this question, if it is still cached."""
+        with self._lock:
+            entry = self._live(self._by_text.get(question))
+            return entry["vec"] if entry is not None else None
+
+    def lookup(
+        self, question: str, namespace: str = "", vec: Optional[List[float]] = None
+    ) -> Tuple[bool, Any, List[float]]:
+        """
+        Return (hit, result, embedding) for question or a near-duplicate. The embedding is
+        returned on a miss so store() can reuse it; it is computed at most once per cached question,
+        and not at all when the caller passes a precomputed vec.
+        """
+        with self._lock:
+            entry = self._live(self._by_text.get(question))
+            if entry is not None and namespace in entry["results"]:
+                return True, entry["results"][namespace], entry["vec"]
+            if vec is None and entry is not None:
+                vec = entry["vec"]
+
+        if vec is None:
+            vec = self.embedding_model.embed_query(question)
+        x = self._unit(vec)
+        with self._lock:
+            entry = self._live(self._nearest(x))
+            if entry is not None and namespace in entry["results"]:
+                log.info("Semantic cache hit", question=question[:200], matched=entry["text"][:200])
+                return True, entry["results"][namespace], vec
+        return False, None, vec
+
+    def store(self, question: str, vec: List[float], result: Any, namespace: str = "") -> None:
+        x = self._unit(vec)
+        with self._lock:
+            entry = self._live(self._nearest(x)) or self._insert(question, vec, x)
+            entry["results"][namespace] = result
+
+    def get_or_search(
+        self,
+        question: str,
+        search_fn: Callable[[List[float]], Any],
+        namespace: str = "",
+    ) -> Any:
+        """Return the cached result for question (or a near-duplicate), else run search_fn on its embedding."""
+        hit, result, vec = self.lookup(question, namespace)
+        if hit:
+            return result
+        result = search_fn(vec)
+        self.store(question, vec, result, namespace)
+        return result
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._by_text.clear()
+            self._index = None
+
+
+def cached_retriever(vectordb, cache: QueryCache, search_type: str = "similarity", **search_kwargs) -> RunnableLambda:
+    """Retriever-compatible runnable that answers from cache before searching vectordb."""
+    namespace = f"{search_type}:{sorted(search_kwargs.items())}"
+
+    def _search(vec: List[float]) -> List[Document]:
+        if search_type == "mmr":
+            return vectordb.max_marginal_relevance_search_by_vector(vec, **search_kwargs)
+        return vectordb.similarity_search_by_vector(vec, **search_kwargs)
+
+    return RunnableLambda(lambda question: cache.get_or_search(question, _search, namespace))
+
+
+class GenerativeCache(QueryCache):
+    """
+    Semantic cache of LLM responses. The question decides the match: a question whose embedding
+    has cosine similarity >= threshold with a cached one gets its response, but only when the
+    formatted context is byte-identical (its SHA-256 is part of the namespace).
+
+    Pass the QueryCache used for retrieval as query_cache so the question vector it already
+    computed is reused instead of embedding the question a second time. Entries live in
+    memory only, so hits come from repeats within one process.
+    """
+
+    def __init__(
+        self,
+        embedding_model,
+        query_cache: Optional[QueryCache] = None,
+        max_size: int = 2000,
+        ttl: float = 600,
+        threshold: float = 0.95,
+    ):
+        super().__init__(embedding_model, max_size=max_size, ttl=ttl, threshold=threshold)
+        self.query_cache = query_cache
+
+    def wrap(self, generator) -> RunnableLambda:
+        """
+        Drop-in replacement for `prompt | llm` in a `{"context", "question"} -> prompt | llm | parser`
+        chain. Misses run the real generator and keep streaming token by token; the aggregated
+        message is stored once the stream ends.
+        """
+        llm = getattr(generator, "last", generator)
+        model = getattr(llm, "model_name", type(llm).__name__)
+
+        def _generate(inputs: Dict[str, str]):
+            question = inputs["question"]
+            context_hash = hashlib.sha256(inputs["context"].encode("utf-8")).hexdigest()
+            namespace = f"llm:{model}:{context_hash}"
+            shared_vec = self.query_cache.vector_for(question) if self.query_cache is not None else None
+            hit, cached, vec = self.lookup(question, namespace, vec=shared_vec)
+            if hit:
+                return cached
+
+            def _record(chunks: Iterator[BaseMessageChunk]) -> Iterator[BaseMessageChunk]:
+                full = None
+                for chunk in chunks:
+                    full = chunk if full is None else full + chunk
+                    yield chunk
+                if full is not None:
+                    self.store(question, vec, full, namespace)
+
+            async def _arecord(chunks: AsyncIterator[BaseMessageChunk]) -> AsyncIterator[BaseMessageChunk]:
+                full = None
+                async for chunk in chunks:
+                    full = chunk if full is None else full + chunk
+                    yield chunk
+                if full is not None:
+                    self.store(question, vec, full, namespace)
+
+            # Returning a runnable makes RunnableLambda invoke/stream it with the same input
+            return generator | RunnableGenerator(_record, _arecord)
+
+        return RunnableLambda(_generate)